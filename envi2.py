@@ -35,7 +35,10 @@
 
 from __future__ import annotations
 
+import csv
 import decimal
+import functools
+import re
 import sys
 from copy import deepcopy
 from pathlib import Path
@@ -47,43 +50,112 @@ import numpy as np
 
 
 def normalize_envi_cube(header, cube):
-    if cube.dtype == 'uint8':
-        return cube.astype('float64') / (2 ** 8 - 1)
+    scale = normalization_scale(header, cube.dtype)
+    # A single fused multiply into a float32 result: no full-cube float64
+    # temporary and half the bytes written compared to astype + divide.
+    return np.multiply(cube, scale, dtype=np.float32)
 
-    elif cube.dtype == 'uint16':
-        # Specim IQ has a 12-bit sensor:
-        if header.get('sensor type').lower() == 'specim iq':
-            cube = cube << 4
-        return cube.astype('float64') / (2 ** 16 - 1)
+
+def normalize_envi_cube_streaming(header, cube):
+    # Multiply one band plane at a time so a memory-mapped cube is paged
+    # in piecewise instead of being pulled into memory all at once.
+    scale = normalization_scale(header, cube.dtype)
+    normalized = np.empty(cube.shape, dtype=np.float32)
+    for b in range(cube.shape[-1]):
+        np.multiply(cube[..., b], scale, out=normalized[..., b])
+    return normalized
+
+
+def normalization_scale(header, dtype) -> np.float32:
+    if dtype == 'uint8':
+        return np.float32(1.0 / (2 ** 8 - 1))
+
+    elif dtype == 'uint16':
+        # Specim IQ has a 12-bit sensor; the traditional `cube << 4`
+        # followed by a divide by 65535 folds into a single constant.
+        if header.get('sensor type', '').lower() == 'specim iq':
+            return np.float32(16.0 / (2 ** 16 - 1))
+        return np.float32(1.0 / (2 ** 16 - 1))
 
     else:
-        raise ValueError(f'Unhandled cube dtype: {cube.dtype}')
+        raise ValueError(f'Unhandled cube dtype: {dtype}')
+
+
+def find_raw_data_file(header_file: Path) -> Path:
+    for raw_data_suffix in ['.raw', '.dat', '.img']:
+        if (raw_data_file := header_file.with_suffix(raw_data_suffix)).exists():
+            return raw_data_file
+    raise FileNotFoundError(f'Could not find data file for header {header_file}')
+
 
+@functools.lru_cache(maxsize=128)
+def _parse_envi_header_cached(header_path: str, mtime_ns: int) -> dict[str, Any]:
+    return parse_envi_header(Path(header_path).read_text('utf-8'))
 
-def read_envi(header_file: Path, data_file: Path | None=None, normalize=True) -> tuple[np.ndarray, np.array, dict[str, Any]]:
-    header = parse_envi_header(header_file.read_text('utf-8'))
+
+def read_envi_header(header_file: Path) -> dict[str, Any]:
+    # Batch runs re-parse the same small headers over and over; cache on
+    # (path, mtime) so an edited file invalidates its entry.  Hand out a
+    # copy so caller mutations (e.g. write_envi) cannot poison the cache.
+    return dict(_parse_envi_header_cached(str(header_file), header_file.stat().st_mtime_ns))
+
+
+def read_envi(header_file: Path, data_file: Path | None=None, normalize=True, use_memmap=True) -> tuple[np.ndarray, np.ndarray, dict[str, Any]]:
+    header = read_envi_header(header_file)
 
     if data_file is None:
-        cube = None
-        for raw_data_suffix in ['.raw', '.dat', '.img']:
-            if (raw_data_file := header_file.with_suffix(raw_data_suffix)).exists():
-                cube = bytes_to_cube(header, raw_data_file.read_bytes())
-                break
+        data_file = find_raw_data_file(header_file)
+
+    if use_memmap:
+        cube = file_to_cube(header, data_file)
+        if normalize:
+            cube = normalize_envi_cube_streaming(header, cube)
     else:
-        cube = bytes_to_cube(header, data_file.read_bytes())
+        cube = load_cube_from_file(header, data_file)
+        if normalize:
+            cube = normalize_envi_cube(header, cube)
+
+    return cube, header['wavelength'], header
+
+
+def read_envi_mean_spectrum(header_file: Path, roi: tuple[int, int, int, int] | None=None, normalize=True) -> tuple[np.ndarray, np.ndarray, dict[str, Any]]:
+    # Average the cube over an optional (row_start, row_stop, col_start,
+    # col_stop) region one band plane at a time, straight off the memory
+    # map.  Peak memory stays O(bands) instead of O(rows * cols * bands),
+    # which matters when only the mean spectrum is needed.
+    header = read_envi_header(header_file)
+    cube = file_to_cube(header, find_raw_data_file(header_file))
 
-    if cube is None:
-        raise FileNotFoundError(f'Could not find data file for header {header_file}')
+    if roi is None:
+        view = cube
+    else:
+        row_start, row_stop, col_start, col_stop = roi
+        view = cube[row_start:row_stop, col_start:col_stop, :]
+
+    bands = view.shape[-1]
+    count = view.shape[0] * view.shape[1]
+    spectrum = np.empty(bands, dtype=np.float32)
+    if np.issubdtype(view.dtype, np.integer):
+        # Sum raw counts in the integer domain (wider SIMD lanes than
+        # float64) and divide once per band instead of once per pixel
+        acc = np.uint64 if np.issubdtype(view.dtype, np.unsignedinteger) else np.int64
+        for b in range(bands):
+            spectrum[b] = view[..., b].sum(dtype=acc) / count
+    else:
+        for b in range(bands):
+            spectrum[b] = view[..., b].mean(dtype=np.float64)
 
     if normalize:
-        cube = normalize_envi_cube(header, cube)
+        spectrum *= normalization_scale(header, cube.dtype)
 
-    return cube, np.array(header['wavelength'], 'float32'), header
+    return spectrum, header['wavelength'], header
 
 
-def read_zipped_envi(zipfile: ZipFile, header_file: Path, normalize=True):
+def read_zipped_envi(zipfile: ZipFile, header_file: Path, normalize=True) -> tuple[np.ndarray, np.ndarray, dict[str, Any]]:
     with zipfile.open(header_file.as_posix()) as zip_header_file:
         header_bytes = zip_header_file.read()
+    header = parse_envi_header(header_bytes.decode('utf-8'))
+
     for raw_data_suffix in ['.raw', '.dat']:
         try:
             raw_info = zipfile.getinfo(header_file.with_suffix(raw_data_suffix).as_posix())
@@ -92,23 +164,32 @@ def read_zipped_envi(zipfile: ZipFile, header_file: Path, normalize=True):
             raw_info = None
     if raw_info is None:
         raise FileNotFoundError('Failed to determine raw data file.')
+
+    # Decompress straight into the cube's own buffer with readinto, so no
+    # interim full-cube bytes object is ever allocated.
+    count = header['lines'] * header['samples'] * header['bands']
+    data = np.empty(count, dtype=envi_dtype(header))
+    buffer = memoryview(data.view(np.uint8))
     with zipfile.open(raw_info) as zip_raw_file:
-        raw_bytes = zip_raw_file.read()
+        offset = 0
+        while offset < len(buffer) and (n := zip_raw_file.readinto(buffer[offset:])) > 0:
+            offset += n
+    if offset != len(buffer):
+        raise ValueError(f'Raw data ended after {offset} of {len(buffer)} bytes.')
 
-    header = parse_envi_header(header_bytes.decode('utf-8'))
-    cube = bytes_to_cube(header, raw_bytes)
+    cube = layout_cube(header, data)
 
     if normalize:
         cube = normalize_envi_cube(header, cube)
 
-    return cube, np.array(header['wavelength']).astype('float32'), header
+    return cube, header['wavelength'], header
 
 def write_envi(header_file: Path, header: dict[str, Any], cube: np.ndarray, wavelengths: np.ndarray, data_file: Path | None=None):
     if data_file is None:
         data_file = header_file.with_suffix('.dat')
 
     header['wavelength'] = wavelengths
-    header, cube_bytes = cube_to_bytes(header, cube)
+    header = cube_to_file(header, data_file, cube)
 
     with header_file.open('wt') as h:
         h.write("ENVI\n")
@@ -135,91 +216,75 @@ def write_envi(header_file: Path, header: dict[str, Any], cube: np.ndarray, wave
             else:
                 raise ValueError(f"Unsupported header field data type: {value}")
 
-    data_file.write_bytes(cube_bytes)
     return header
 
 
+# header field grammar, compiled once so the hot parsing loops run in C
+_ASSIGNMENT_RE = re.compile(r'[ \t]*=[ \t]*')
+_LIST_RE = re.compile(r'\{([^}]*)\}\n')
+
+
+# known header fields and their value parsers
+_FIELD_TYPES = {
+    'acquisition time': dateutil.parser.isoparse,
+    'bands': int,
+    'byte order': int,
+    'data gain values': float,
+    'data type': int,
+    'fwhm': float,
+    'lines': int,
+    'samples': int,
+
+    # Senop HSC-2
+    'senop acquisition mode': int,
+    'senop frame counter': int,
+    'senop integration time': float,
+    'senop order': int,
+    'senop sequence order': int,
+    'senop timestamp': int,
+    'senop acceleration': lambda x: tuple(map(decimal.Decimal, x.split(','))),
+    'senop gyroscope': lambda x: tuple(map(decimal.Decimal, x.split(','))),
+}
+
+
 def parse_envi_header(to_be_parsed: str) -> dict:
     def fix_header_field_types(stringy_header: dict[str, str | list[str]]) -> dict[str, Any]:
-        field_types = {
-            'acquisition time': dateutil.parser.isoparse,
-            'bands': int,
-            'byte order': int,
-            'data gain values': float,
-            'data type': int,
-            'fwhm': float,
-            'lines': int,
-            'samples': int,
-            'wavelength': float,
-
-            # Senop HSC-2
-            'senop acquisition mode': int,
-            'senop frame counter': int,
-            'senop integration time': float,
-            'senop order': int,
-            'senop sequence order': int,
-            'senop timestamp': int,
-            'senop acceleration': lambda x: tuple(map(decimal.Decimal, x.split(','))),
-            'senop gyroscope': lambda x: tuple(map(decimal.Decimal, x.split(','))),
-        }
-        for f, t in field_types.items():
-            if f in stringy_header:
-                if isinstance(stringy_header[f], list):
-                    stringy_header[f] = list(map(t, stringy_header[f]))
+        # One pass over the header with a dict lookup per field, rather
+        # than probing the header for every known field type
+        for f, value in stringy_header.items():
+            if (t := _FIELD_TYPES.get(f)) is not None:
+                if isinstance(value, list):
+                    stringy_header[f] = [t(x) for x in value]
                 else:
-                    stringy_header[f] = t(stringy_header[f])
+                    stringy_header[f] = t(value)
         return stringy_header
 
     # assignment -> { " " | "\t" } "=" { " " | "\t" }
     def parse_assignment(s: str) -> tuple[str, str]:
-        i = 0
-        while s[i] in [' ', '\t']:
-            i = i + 1
-        if s[i] != '=':
+        if (m := _ASSIGNMENT_RE.match(s)) is None:
             raise ValueError('Expected "="')
-        i = i + 1
-        while s[i] in [' ', '\t']:
-            i = i + 1
-        return s[i:], s[:i]
+        return s[m.end():], m.group(0)
 
     # identifier -> { ^"=" }
     def parse_identifier(s: str) -> tuple[str, str]:
-        i = 0
-        while s[i] != '=':
-            i = i + 1
+        i = s.index('=')
         return s[i:], s[:i].strip()
 
     # value -> *\n | "{" ? "}"
     def parse_value(s: str) -> tuple[str, str | list[str]]:
-        def parse_list(ls: str) -> tuple[str, list[str]]:
-            values = []
-            i = 1
-            while ls[i] != '}':
-                s = i
-                e = 1
-                while ls[i] != ',' and ls[i] != '}':
-                    if ls[i] == '"':
-                        i = i + 1
-                        s = i
-                        while ls[i] != '"':
-                            i += 1
-                        e = i
-                        i += 1
-                    else:
-                        i += 1
-                        e = i
-                values.append(ls[s:e].strip())
-                if ls[i] == ',':
-                    i = i + 1
-            if ls[i:i + 2] != '}\n':
-                raise ValueError('Expected }')
-            return ls[i + 2:], values
-
         if s[0] == '{':
-            return parse_list(to_be_parsed)
-        i = 0
-        while s[i] != '\n':
-            i = i + 1
+            if (m := _LIST_RE.match(s)) is None:
+                raise ValueError('Expected }')
+            body = m.group(1)
+            if '"' in body:
+                # csv tokenizes in C and keeps commas inside quotes intact;
+                # fold wrapped lines first, csv.reader chokes on newlines
+                body = body.replace('\n', ' ')
+                values = [v.strip() for v in next(csv.reader([body], skipinitialspace=True))]
+            else:
+                values = [v.strip() for v in body.split(',')] if body else []
+            return s[m.end():], values
+        i = s.index('\n')
         return s[i + 1:], s[:i]
 
     # Ditch DOS/Windows line ends for Unixy approach
@@ -240,110 +305,126 @@ def parse_envi_header(to_be_parsed: str) -> dict:
         to_be_parsed, value = parse_value(to_be_parsed)
         header[ident] = value
 
-    # Duck manufacturers! Make keys lowercase
-    lowercased_header = {}
-    for key, value in header.items():
-        if key.islower():
-            lowercased_header[key] = value
-        else:
-            lowercased_header[key.lower()] = value
-    header = lowercased_header
+    # Duck manufacturers! Make keys lowercase, but only rebuild the dict
+    # when some manufacturer actually used upper case
+    if not all(key.islower() for key in header):
+        header = {key.lower(): value for key, value in header.items()}
 
     header = fix_header_field_types(header)
 
+    # Convert the wavelengths straight to the float32 array the readers
+    # hand out, once at parse time instead of on every read; numpy parses
+    # the value strings itself
+    if 'wavelength' in header:
+        header['wavelength'] = np.asarray(header['wavelength'], dtype=np.float32)
+
     return header
 
 
-def bytes_to_cube(header: dict[str, Any], b: bytes) -> np.ndarray:
-    if (header_byte_order := header['byte order']) == 0:
-        byte_order = '<'
-    elif header_byte_order == 1:
-        byte_order = '>'
-    else:
+# ENVI header codes -> numpy dtype components
+_ENVI_BYTE_ORDERS = {0: '<', 1: '>'}
+_ENVI_DATA_TYPES = {1: 'u1', 2: 'i2', 3: 'i4', 4: 'f4', 5: 'f8', 12: 'u2'}
+
+
+@functools.lru_cache(maxsize=None)
+def _envi_dtype(header_byte_order: int, header_data_type: int) -> np.dtype:
+    if (byte_order := _ENVI_BYTE_ORDERS.get(header_byte_order)) is None:
         raise ValueError(f'Unknown byte order {header_byte_order}')
 
-    if (header_data_type := header['data type']) == 1:
-        data_type = 'u1'
-    elif header_data_type == 2:
-        data_type = 's2'
-    elif header_data_type == 3:
-        data_type = 's4'
-    elif header_data_type == 4:
-        data_type = 'f4'
-    elif header_data_type == 5:
-        data_type = 'f8'
-    elif header_data_type == 12:
-        data_type = 'u2'
-    else:
+    if (data_type := _ENVI_DATA_TYPES.get(header_data_type)) is None:
         raise ValueError(f'Unknown data type {header_data_type}.')
 
-    dtype = np.dtype(f'{byte_order}{data_type}')
-    rows = header['lines']
-    cols = header['samples']
-    bands = header['bands']
+    return np.dtype(f'{byte_order}{data_type}')
+
 
-    data = np.frombuffer(b, dtype)
+def envi_dtype(header: dict[str, Any]) -> np.dtype:
+    return _envi_dtype(header['byte order'], header['data type'])
 
-    if (header_interleave := header['interleave'].lower()) == 'bil':
-        # BIL stack has the images laid out horizontally in a (rows, cols * bands) matrix
-        data = data.reshape((rows, cols * bands))
-        data = data.reshape(rows, cols, bands, order='F')
 
-    elif header_interleave == 'bip':
-        data = data.reshape((bands, rows * cols), order='F')
-        data = data.reshape(bands, rows, cols, order='C')
+@functools.lru_cache(maxsize=None)
+def _cube_layout(interleave: str, rows: int, cols: int, bands: int) -> tuple[tuple[int, int, int], tuple[int, int, int]]:
+    # A camera produces one (interleave, shape) combination for its whole
+    # run, so the natural on-disk shape and the transpose that yields
+    # (rows, cols, bands) are resolved once and served from the cache.
+    if interleave == 'bil':
+        # BIL stores each row as a (bands, cols) block
+        return (rows, bands, cols), (0, 2, 1)
 
-    elif header_interleave == 'bsq':
-        # BSQ stack has the band images layered sequentially (rows, cols, bands)
-        data = data.reshape((bands, rows, cols))
-        data = np.swapaxes(data, 0, 2)
-        data = np.swapaxes(data, 0, 1)
+    elif interleave == 'bip':
+        # BIP is already band-interleaved per pixel
+        return (rows, cols, bands), (0, 1, 2)
+
+    elif interleave == 'bsq':
+        # BSQ stack has the band images layered sequentially
+        return (bands, rows, cols), (1, 2, 0)
 
     else:
-        raise ValueError(f'Unknown interleave {header_interleave}.')
+        raise ValueError(f'Unknown interleave {interleave}.')
+
 
-    return data
+def file_to_cube(header: dict[str, Any], raw_data_file: Path) -> np.ndarray:
+    # Memory-map the raw data so the OS page cache streams the cube on
+    # demand instead of materializing a full in-memory copy up front.
+    shape, axes = _cube_layout(header['interleave'].lower(), header['lines'],
+                               header['samples'], header['bands'])
+    return np.memmap(raw_data_file, dtype=envi_dtype(header), mode='r', shape=shape).transpose(axes)
+
+
+def load_cube_from_file(header: dict[str, Any], raw_data_file: Path) -> np.ndarray:
+    # np.fromfile freads straight into a single numpy allocation, unlike
+    # read_bytes + np.frombuffer which goes through an interim bytes object
+    count = header['lines'] * header['samples'] * header['bands']
+    return layout_cube(header, np.fromfile(raw_data_file, dtype=envi_dtype(header), count=count))
+
+
+def bytes_to_cube(header: dict[str, Any], b: bytes) -> np.ndarray:
+    return layout_cube(header, np.frombuffer(b, envi_dtype(header)))
+
+
+def layout_cube(header: dict[str, Any], data: np.ndarray) -> np.ndarray:
+    # Reshape to the natural on-disk layout and transpose into
+    # (rows, cols, bands); both steps are views, so no sample is copied.
+    shape, axes = _cube_layout(header['interleave'].lower(), header['lines'],
+                               header['samples'], header['bands'])
+    return data.reshape(shape).transpose(axes)
 
 
 def cube_to_bytes(header: dict[str, Any], data: np.ndarray) -> tuple[dict[str, Any], bytes]:
+    header = envi_output_header(header, data)
+    # One contiguous transpose into BSQ order; tobytes on the contiguous
+    # result is a straight memcpy instead of a second strided traversal.
+    return header, np.ascontiguousarray(data.transpose(2, 0, 1)).tobytes()
+
+
+def cube_to_file(header: dict[str, Any], data_file: Path, data: np.ndarray) -> dict[str, Any]:
+    header = envi_output_header(header, data)
+    # tofile writes the view in C order itself, so no full-size bytes
+    # object is ever allocated.
+    data.transpose(2, 0, 1).tofile(data_file)
+    return header
+
+
+# numpy dtype -> (ENVI data type code, reflectance scale factor)
+# No entry for data type 6: numpy has no 32-bit complex numbers
+_ENVI_OUTPUT_TYPES = {
+    np.dtype(np.float32): (4, 1.0),
+    np.dtype(np.float64): (5, 1.0),
+    np.dtype(np.complex64): (9, 1.0),
+    np.dtype(np.int16): (2, np.iinfo(np.int16).max),
+    np.dtype(np.int32): (3, np.iinfo(np.int32).max),
+    np.dtype(np.int64): (14, np.iinfo(np.int64).max),
+    np.dtype(np.uint8): (1, np.iinfo(np.uint8).max),
+    np.dtype(np.uint16): (12, np.iinfo(np.uint16).max),
+    np.dtype(np.uint32): (13, np.iinfo(np.uint32).max),
+    np.dtype(np.uint64): (15, np.iinfo(np.uint64).max),
+}
+
+
+def envi_output_header(header: dict[str, Any], data: np.ndarray) -> dict[str, Any]:
     header = deepcopy(header)
-    match data.dtype:
-        case np.float32:
-            data_type = 4
-            reflectance_scale_factor = 1.0
-        case np.float64:
-            data_type = 5
-            reflectance_scale_factor = 1.0
-# No 32-bit complex numbers in numpy
-#        case np.complex32:
-#            data_type = 6
-#            reflectance_scale_factor = 1.0
-        case np.complex64:
-            data_type = 9
-            reflectance_scale_factor = 1.0
-        case np.int16:
-            data_type = 2
-            reflectance_scale_factor = np.iinfo(data.dtype).max
-        case np.int32:
-            data_type = 3
-            reflectance_scale_factor = np.iinfo(data.dtype).max
-        case np.int64:
-            data_type = 14
-            reflectance_scale_factor = np.iinfo(data.dtype).max
-        case np.uint8:
-            data_type = 1
-            reflectance_scale_factor = np.iinfo(data.dtype).max
-        case np.uint16:
-            data_type = 12
-            reflectance_scale_factor = np.iinfo(data.dtype).max
-        case np.uint32:
-            data_type = 13
-            reflectance_scale_factor = np.iinfo(data.dtype).max
-        case np.uint64:
-            data_type = 15
-            reflectance_scale_factor = np.iinfo(data.dtype).max
-        case _:
-            raise ValueError(f"Unsupported data type: {data.dtype}")
+    if (output_type := _ENVI_OUTPUT_TYPES.get(data.dtype)) is None:
+        raise ValueError(f"Unsupported data type: {data.dtype}")
+    data_type, reflectance_scale_factor = output_type
 
     match data.dtype.byteorder:
         case '=':
@@ -363,7 +444,4 @@ def cube_to_bytes(header: dict[str, Any], data: np.ndarray) -> tuple[dict[str, A
     header['interleave'] = "BSQ"
     header['reflectance scale factor'] = reflectance_scale_factor
 
-    data = np.swapaxes(data, 0, 1)
-    data = np.swapaxes(data, 0, 2)
-
-    return header, data.tobytes(order='C')
+    return header
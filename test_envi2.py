@@ -0,0 +1,24 @@
+import numpy as np
+
+from envi2 import parse_envi_header
+
+
+def test_parse_multiline_quoted_list():
+    # ENVI headers routinely wrap long lists across lines; quoted entries
+    # may contain commas and must not be split
+    header = parse_envi_header(
+        'ENVI\n'
+        'band names = {band 1,\n'
+        ' "band, two",\n'
+        ' band 3}\n'
+    )
+    assert header['band names'] == ['band 1', 'band, two', 'band 3']
+
+
+def test_parse_multiline_wavelength_list():
+    header = parse_envi_header(
+        'ENVI\n'
+        'wavelength = {500.0, 600.0,\n'
+        ' 700.0}\n'
+    )
+    assert np.allclose(header['wavelength'], [500.0, 600.0, 700.0])